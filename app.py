@@ -1,6 +1,13 @@
-import json
-
-from flask import Flask, request
+from contextlib import contextmanager
+
+import orjson
+from flask import Flask, Response, g, request, stream_with_context
+from sqlalchemy import event
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import QueuePool
 import users_dao
 from datetime import datetime
 
@@ -15,11 +22,79 @@ app = Flask(__name__)
 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+app.config["SQLALCHEMY_ECHO"] = False
+engine_options = {
+    "poolclass": QueuePool,
+    "pool_size": 32,
+    "max_overflow": 16,
+    "pool_pre_ping": False,
+    "pool_recycle": 1800,
+    "query_cache_size": 1200,
+    "connect_args": {"check_same_thread": False, "timeout": 30},
+}
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+# separate pool of read-only connections for endpoints that only select
+app.config["SQLALCHEMY_BINDS"] = {
+    "readonly": {
+        "url": "sqlite:///file:%s?mode=ro&uri=true" % db_filename,
+        **engine_options,
+    },
+}
+
+# pragmas applied to every new sqlite connection
+sqlite_pragmas = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=30000",
+]
+readonly_pragmas = [
+    "PRAGMA query_only=1",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=30000",
+]
+
+
+def pragma_listener(pragmas):
+    """
+    Returns a connect listener that runs the given pragmas on each new sqlite
+    connection before it is added to the pool
+    """
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return set_sqlite_pragmas
+
 
 db.init_app(app)
 with app.app_context():
-    db.create_all()
+    event.listen(db.engine, "connect", pragma_listener(sqlite_pragmas))
+    event.listen(db.engines["readonly"], "connect",
+                 pragma_listener(readonly_pragmas))
+    db.create_all(bind_key=None)
+    # create_all skips existing tables, so add any indexes they are missing
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # don't hand the startup connections to forked server workers
+    db.engine.dispose()
+
+
+@contextmanager
+def readonly_session():
+    """
+    Context manager that yields a session bound to the read-only engine
+    """
+    session = Session(bind=db.engines["readonly"])
+    try:
+        yield session
+    finally:
+        session.close()
 
 
 # generalized response formats
@@ -27,28 +102,79 @@ def success_response(data, code=200):
     """
     Generalized success response function
     """
-    return json.dumps(data), code
+    return orjson.dumps(data), code, {"Content-Type": "application/json"}
 
 
 def failure_response(message, code=404):
     """
     Generalized failure response function
     """
-    return json.dumps({"error": message}), code
+    return orjson.dumps({"error": message}), code, {"Content-Type": "application/json"}
+
+
+def stream_response(key, statement, serialize):
+    """
+    Generalized streaming success response for a list of rows, encoding each
+    row as it is fetched instead of building the whole list in memory
+    """
+    def generate():
+        with readonly_session() as session:
+            rows = session.execute(
+                statement.execution_options(yield_per=100)).scalars()
+            yield b"{" + orjson.dumps(key) + b":["
+            for i, row in enumerate(rows):
+                if i:
+                    yield b","
+                yield orjson.dumps(serialize(row))
+            yield b"]}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def add_and_flush(obj):
+    """
+    Helper function that adds an object to the session and flushes it so its
+    id is assigned; the request's changes are committed by commit_session
+    """
+    db.session.add(obj)
+    db.session.flush()
+
+
+@app.after_request
+def commit_session(response):
+    """
+    Commits the changes made while handling a successful request in a single
+    transaction; failed requests are rolled back when the session is removed
+    """
+    if response.status_code < 400:
+        db.session.commit()
+    return response
 
 
 def extract_token(request):
     """
-    Helper function that extracts the token from the header of a request
+    Helper function that extracts the token from the header of a request,
+    parsing the header at most once per request
     """
-    auth_header = request.headers.get("Authorization")
+    if "bearer_token" not in g:
+        g.bearer_token = parse_bearer_token(
+            request.headers.get("Authorization"))
+    return g.bearer_token
+
 
+def parse_bearer_token(auth_header):
+    """
+    Helper function that parses a bearer token out of an authorization header
+    """
     if auth_header is None:
         return False, failure_response("Missing authorization header.", 400)
 
-    bearer_token = auth_header.replace("Bearer ", "").strip()
+    if not auth_header.startswith("Bearer "):
+        return False, failure_response("Invalid authorization header.", 400)
+
+    bearer_token = auth_header[7:].strip()
 
-    if bearer_token is None or not bearer_token:
+    if not bearer_token:
         return False, failure_response("Invalid authorization header.", 400)
 
     return True, bearer_token
@@ -67,7 +193,7 @@ def register_account():
     """
     Endpoint for registering a new user
     """
-    body = json.loads(request.data)
+    body = orjson.loads(request.get_data(cache=False))
 
     name = body.get("name")
     netid = body.get("netid")
@@ -91,11 +217,7 @@ def register_account():
     if not success:
         return failure_response("User already exists", 400)
 
-    return success_response({
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token
-    })
+    return success_response(user.serialize_session())
 
 
 @app.route("/login/", methods=["POST"])
@@ -103,7 +225,7 @@ def login():
     """
     Endpoint for logging in a user
     """
-    body = json.loads(request.data)
+    body = orjson.loads(request.get_data(cache=False))
     email = body.get("email")
     password = body.get("password")
 
@@ -115,11 +237,7 @@ def login():
     if not success:
         return failure_response("Incorrect email or password", 401)
 
-    return success_response({
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token
-    })
+    return success_response(user.serialize_session())
 
 
 @app.route("/session/", methods=["POST"])
@@ -136,11 +254,7 @@ def update_session():
     if not success_user:
         return failure_response("Invalid update token", 400)
 
-    return success_response({
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token
-    })
+    return success_response(user.serialize_session())
 
 
 @app.route("/secret/", methods=["GET"])
@@ -153,9 +267,7 @@ def secret_message():
     if not success:
         return failure_response("Session token invalid.", 400)
 
-    user = users_dao.get_user_by_session_token(session_token)
-
-    if user is None or not user.verify_session_token(session_token):
+    if not users_dao.verify_session(session_token):
         return failure_response("Invalid session token.", 400)
 
     return success_response("You have successfully implemented sessions!")
@@ -175,11 +287,9 @@ def logout():
     if user is None or not user.verify_session_token(session_token):
         return failure_response("Invalid session token", 400)
 
-    user.session_token = ""
-    user.session_expiration = datetime.datetime.now()
-    user.update_token = ""
+    users_dao.invalidate_session(session_token)
+    user.end_session()
 
-    db.session.commit()
     return success_response("You have successfully logged out")
 
 
@@ -189,11 +299,7 @@ def get_all_locations():
     Endpoint for getting all locations
     """
 
-    locations = []
-    for l in Location.query.all():
-        loc = l.serialize()
-        locations.append(loc)
-    return success_response({"locations": locations})
+    return stream_response("locations", select(Location), Location.serialize)
 
 
 @app.route("/api/locations/", methods=["POST"])
@@ -201,7 +307,7 @@ def create_location():
     """
     Endpoint for creating a location
     """
-    body = json.loads(request.data)
+    body = orjson.loads(request.get_data(cache=False))
     code = body.get("code")
     if code is None:
         return failure_response("No code", 400)
@@ -228,8 +334,7 @@ def create_location():
 
     location = Location(code=code, name=name, address=address, weekday_operating_start=weekday_operating_start, weekday_operating_end=weekday_operating_end,
                         weekend_operating_start=weekend_operating_start, weekend_operating_end=weekday_operating_end)
-    db.session.add(location)
-    db.session.commit()
+    add_and_flush(location)
 
     new_location = {
         "id": location.id,
@@ -249,10 +354,11 @@ def get_location(id):
     Endpoint for getting a location by id
     """
 
-    location = Location.query.filter_by(id=id).first()
-    if location is None:
-        return failure_response("Location not found")
-    return success_response(location.serialize())
+    with readonly_session() as session:
+        location = session.get(Location, id)
+        if location is None:
+            return failure_response("Location not found")
+        return success_response(location.serialize())
 
 
 @app.route("/api/locations/<int:id>/", methods=["DELETE"])
@@ -261,12 +367,11 @@ def delete_location(id):
     Endpoint for deleting a course by id
     """
 
-    location = Location.query.filter_by(id=id).first()
+    location = db.session.get(Location, id)
     if location is None:
         return failure_response("Location not found")
 
     db.session.delete(location)
-    db.session.commit()
     return success_response(location.serialize())
 
 
@@ -276,10 +381,12 @@ def get_user(id):
     Endpoint for getting a user by id
     """
 
-    user = Users.query.filter_by(id=id).first()
-    if user is None:
-        return failure_response("User not found")
-    return success_response(user.serialize())
+    with readonly_session() as session:
+        user = session.get(
+            Users, id, options=[selectinload(Users.reservations)])
+        if user is None:
+            return failure_response("User not found")
+        return success_response(user.serialize())
 
 
 @app.route("/api/users/<int:id>/", methods=["DELETE"])
@@ -288,12 +395,14 @@ def delete_user(id):
     Endpoint for deleting a user by id
     """
 
-    user = Users.query.filter_by(id=id).first()
+    user = db.session.get(
+        Users, id, options=[selectinload(Users.reservations)])
     if user is None:
         return failure_response("User not found")
 
+    users_dao.invalidate_session(user.session_token)
+    users_dao.forget_logins(user.id)
     db.session.delete(user)
-    db.session.commit()
     return success_response(user.serialize())
 
 
@@ -302,15 +411,14 @@ def create_facility(location_id):
     """
     Endpoint for creating facilities
     """
-    body = json.loads(request.data)
+    body = orjson.loads(request.get_data(cache=False))
 
     name = body.get("name")
     if name is None:
         return failure_response("Missing name", 200)
     facility = Facility(name=name, location_id=location_id)
 
-    db.session.add(facility)
-    db.session.commit()
+    add_and_flush(facility)
 
     return success_response(facility.serialize())
 
@@ -320,15 +428,12 @@ def get_all_facility(location_id):
     """
     Get all facilities of a location.
     """
-    facilities = Facility.query.filter_by(location_id=location_id)
-    if facilities is None:
-        return failure_response("Facility not found")
-
-    f = []
-    for fac in facilities:
-        facility = fac.simple_serialize()
-        f.append(facility)
-    return success_response({"facilities": f})
+    facilities = (
+        select(Facility)
+        .options(load_only(Facility.id, Facility.name))
+        .where(Facility.location_id == location_id)
+    )
+    return stream_response("facilities", facilities, Facility.simple_serialize)
 
 
 @app.route("/api/locations/<int:location_id>/facilities/<int:facility_id>/")
@@ -336,11 +441,11 @@ def get_facility(location_id, facility_id):
     """
     Get a specific facility of a location by id.
     """
-    facility = Facility.query.filter_by(
-        location_id=location_id, id=facility_id).first()
-    if facility is None:
-        return failure_response("Facility not found")
-    return success_response(facility.simple_serialize())
+    with readonly_session() as session:
+        facility = session.get(Facility, facility_id)
+        if facility is None or facility.location_id != location_id:
+            return failure_response("Facility not found")
+        return success_response(facility.simple_serialize())
 
 
 @app.route("/api/locations/<int:location_id>/facilities/<int:facility_id>/add/", methods=["POST"])
@@ -349,17 +454,18 @@ def add_reservation(location_id, facility_id):
     Endpoint for adding a reservation for a specific user
     """
     success, session_token = extract_token(request)
-    user = Users.query.filter_by(
-        session_token=session_token).first()  # authentication
-    if user is None:
+    if not success:
+        return failure_response("Failed to authenticate.")
+
+    user = users_dao.get_user_by_session_token(session_token)  # authentication
+    if user is None or not user.verify_session_token(session_token):
         return failure_response("Failed to authenticate.")
 
-    facility = Facility.query.filter_by(
-        id=facility_id, location_id=location_id).first()
+    facility = db.session.get(Facility, facility_id)
 
-    if facility is None:
+    if facility is None or facility.location_id != location_id:
         return failure_response("Facility not found.")
-    body = json.loads(request.data)
+    body = orjson.loads(request.get_data(cache=False))
 
     start_time = body.get("start_time")
     end_time = body.get("end_time")
@@ -369,21 +475,20 @@ def add_reservation(location_id, facility_id):
     start_time = datetime.strptime(start_time, '%m/%d/%y %H:%M:%S')
     end_time = datetime.strptime(end_time, '%m/%d/%y %H:%M:%S')
 
-    # check if user inputted start time is between any other reservation's start and end time
-    # check if user inputted end time is between any other reservation's start and end time
-    # cuz this means that user is trying to start or end a reservation during another reservation
-    # loop through all reservations at the facility the user is trying to reserve
+    # a reservation conflicts if it starts before the new one ends and ends
+    # after the new one starts; the (facility_id, start_time, end_time) index
+    # lets sqlite answer this without loading the facility's reservations
 
-    for reservation in Reservation.query.filter_by(facility_id=facility_id):
-        if reservation.start_time < start_time and reservation.end_time > start_time:
-            return failure_response("Start time is during another reservation.")
-        if reservation.start_time < end_time and reservation.end_time > end_time:
-            return failure_response("End time is during another reservation.")
+    conflict = db.session.query(Reservation.id).filter(
+        Reservation.facility_id == facility.id,
+        Reservation.start_time < end_time,
+        Reservation.end_time > start_time).first()
+    if conflict is not None:
+        return failure_response("Reservation overlaps with another reservation.")
 
     reserve = Reservation(user_id=user.id, facility_id=facility.id,
                           start_time=start_time, end_time=end_time)
-    db.session.add(reserve)
-    db.session.commit()
+    add_and_flush(reserve)
     return success_response(reserve.serialize())
 
 
@@ -392,19 +497,20 @@ def cancel_reservation(reservation_id):
     """
     Endpoint for cancelling a reservation for a specific user
     """
-    reserve = Reservation.query.filter_by(id=reservation_id).first()
     success, session_token = extract_token(request)
-    user = Users.query.filter_by(
-        session_token=session_token).first()  # authentication
-    if user is None:
+    if not success:
+        return failure_response("Failed to authenticate.")
+
+    user = users_dao.get_user_by_session_token(session_token)  # authentication
+    if user is None or not user.verify_session_token(session_token):
         return failure_response("Failed to authenticate.")
 
+    reserve = db.session.get(Reservation, reservation_id)
     if reserve is None:
         return failure_response("reservastion not found")
     db.session.delete(reserve)
-    db.session.commit()
     return success_response(reserve.serialize())
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    app.run(host="0.0.0.0", port=8000)
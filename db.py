@@ -1,18 +1,25 @@
 import datetime
-import hashlib
 import os
+import secrets
 
 import bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+# cost factor for password hashes; each extra round doubles hashing time
+bcrypt_rounds = int(os.environ.get("BCRYPT_ROUNDS", 12))
+
 
 class Reservation(db.Model):
     __tablename__ = "reservations"
+    __table_args__ = (
+        db.Index("ix_res_fac_time", "facility_id", "start_time", "end_time"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        "users.id"), nullable=False, index=True)
     facility_id = db.Column(db.Integer, db.ForeignKey(
         "facilities.id"), nullable=False)
     start_time = db.Column(db.DateTime, nullable=False)
@@ -38,8 +45,8 @@ class Reservation(db.Model):
             "id": self.id,
             "user_id": self.user_id,
             "facility_id": self.facility_id,
-            "start_time": str(self.start_time),
-            "end_time": str(self.end_time),
+            "start_time": self.start_time,
+            "end_time": self.end_time,
         }
 
 
@@ -72,7 +79,7 @@ class Users(db.Model):
         self.netid = kwargs.get("netid", "")
         self.email = kwargs.get("email", "")
         self.password_digest = bcrypt.hashpw(kwargs.get(
-            "password").encode("utf8"), bcrypt.gensalt(rounds=13))
+            "password").encode("utf8"), bcrypt.gensalt(rounds=bcrypt_rounds))
         self.renew_session()
 
     def serialize(self):
@@ -98,11 +105,21 @@ class Users(db.Model):
             "email": self.email,
         }
 
+    def serialize_session(self):
+        """
+        Serializes the session information of a User object
+        """
+        return {
+            "session_token": self.session_token,
+            "session_expiration": self.session_expiration,
+            "update_token": self.update_token
+        }
+
     def _urlsafe_base_64(self):
         """
         Randomly generates hashed tokens (used for session/update tokens)
         """
-        return hashlib.sha1(os.urandom(64)).hexdigest()
+        return secrets.token_urlsafe(32)
 
     def renew_session(self):
         """
@@ -115,6 +132,16 @@ class Users(db.Model):
         self.session_expiration = datetime.datetime.now() + datetime.timedelta(days=1)
         self.update_token = self._urlsafe_base_64()
 
+    def end_session(self):
+        """
+        Ends the session, i.e.
+        1. Expires the session now
+        2. Replaces the session and update tokens so neither can be reused
+        """
+        self.session_token = self._urlsafe_base_64()
+        self.session_expiration = datetime.datetime.now()
+        self.update_token = self._urlsafe_base_64()
+
     def verify_password(self, password):
         """
         Verifies the password of a user
@@ -191,7 +218,7 @@ class Facility(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String, nullable=False)
     location_id = db.Column(db.Integer, db.ForeignKey(
-        "location.id"), nullable=False)
+        "location.id"), nullable=False, index=True)
     reservations = db.relationship("Reservation", back_populates="facility")
 
     def __init__(self, **kwargs):
@@ -0,0 +1,13 @@
+import multiprocessing
+
+bind = "0.0.0.0:8000"
+# one worker per core with a few threads each, rather than the 2n+1 sync
+# worker formula; bcrypt releases the GIL, so the threads already keep the
+# cores busy, and fewer workers means fewer cold copies of the per-process
+# session, login and missing email caches
+workers = multiprocessing.cpu_count()
+worker_class = "gthread"
+threads = 4
+timeout = 60
+# import the app once so the tables are created before workers fork
+preload_app = True
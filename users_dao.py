@@ -2,42 +2,328 @@
 DAO (Data Access Object) file
 
 Helper file containing functions for accessing data in our database
+
+Functions that modify data leave the changes in the session; they are
+committed once at the end of the request by app.commit_session
 """
+import collections
+import concurrent.futures
+import datetime
+import functools
+import hashlib
+import hmac
+import os
+import threading
+
+from cachetools import TLRUCache
+from cachetools import TTLCache
+from flask import g
+from flask import has_request_context
+from sqlalchemy import event
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm import make_transient_to_detached
+
 from db import db
 from db import Users
 
+# per-process key for the cache digests, so cached keys cannot be used as
+# session tokens or password hashes outside this process
+_cache_key = os.urandom(32)
+
+# bounds on the per-worker session cache; other workers cannot evict a
+# logged out token, so the ttl is how long one may stay valid there
+session_cache_size = int(os.environ.get("SESSION_CACHE_SIZE", 2048))
+session_cache_ttl = int(os.environ.get("SESSION_CACHE_TTL", 30))
+
+# what the session cache keeps for a session token: plain values with a
+# fixed layout, never an ORM object
+SessionView = collections.namedtuple(
+    "SessionView", ["user_id", "session_expiration"])
+
+
+def _session_ttu(key, session, now):
+    """
+    Returns when a cached session expires: after session_cache_ttl seconds,
+    or when the session itself expires if that is sooner
+    """
+    remaining = (session.session_expiration -
+                 datetime.datetime.now()).total_seconds()
+    return now + min(session_cache_ttl, remaining)
+
+
+# session token digest -> SessionView of unexpired sessions, shared by a
+# worker's threads
+_session_cache = TLRUCache(maxsize=session_cache_size, ttu=_session_ttu)
+_session_cache_lock = threading.Lock()
+# session token digest -> future for the database load of that token that
+# is in progress, shared by the threads waiting on it
+_session_loads = {}
+
+# the columns routes authenticating with a session token need from a user
+_session_columns = (Users.id, Users.session_token, Users.session_expiration)
+
+# digests of emails recently looked up with no matching user; kept short
+# since a signup handled by another worker cannot evict them
+_missing_email_cache = TTLCache(maxsize=10000, ttl=10)
+_missing_email_cache_lock = threading.Lock()
+
+# digest of recently verified credentials -> (user id, password digest);
+# the password digest ties an entry to the account it was verified against,
+# since sqlite can hand a deleted user's id to a later signup
+_login_cache = TTLCache(maxsize=10000, ttl=60)
+_login_cache_lock = threading.Lock()
+
+
+def _digest(value):
+    """
+    Returns the keyed digest of a value, used as its cache key
+    """
+    return hmac.new(_cache_key, value, hashlib.sha256).digest()
+
+
+def _request_cached(fn):
+    """
+    Decorator that memoizes a single-argument user lookup for the rest of
+    the current request
+    """
+    @functools.wraps(fn)
+    def wrapper(key):
+        if not has_request_context():
+            return fn(key)
+
+        cache = g.setdefault("_user_cache", {})
+        cache_key = (fn.__name__, key)
+        if cache_key not in cache:
+            cache[cache_key] = fn(key)
+        return cache[cache_key]
+
+    return wrapper
 
+
+def _clear_request_cache():
+    """
+    Drops the current request's memoized user lookups
+    """
+    if has_request_context():
+        g.pop("_user_cache", None)
+
+
+@event.listens_for(db.session, "after_commit")
+def _evict_after_commit(session):
+    """
+    Evicts the cache entries the committed transaction made stale; a lookup
+    racing the request may have re-cached them from the old rows before the
+    changes became visible
+
+    - emails of created users, from the missing email cache
+    - ended session tokens, from the session cache
+    """
+    keys = session.info.pop("created_emails", ())
+    with _missing_email_cache_lock:
+        for key in keys:
+            _missing_email_cache.pop(key, None)
+
+    keys = session.info.pop("ended_sessions", ())
+    with _session_cache_lock:
+        for key in keys:
+            _session_cache.pop(key, None)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_evictions(session):
+    """
+    Drops the pending evictions of a rolled back transaction
+    """
+    session.info.pop("created_emails", None)
+    session.info.pop("ended_sessions", None)
+
+
+@_request_cached
 def get_user_by_email(email):
     """
     Returns a user object from the database given an email
+
+    Emails without a user are remembered briefly, so repeated failed logins
+    for unknown emails do not each query the database
     """
-    return Users.query.filter(Users.email == email).first()
+    key = _digest(email.encode("utf8"))
+    with _missing_email_cache_lock:
+        if key in _missing_email_cache:
+            return None
 
+    user = db.session.execute(
+        select(Users).where(Users.email == email)).scalar_one_or_none()
+    if user is None:
+        with _missing_email_cache_lock:
+            _missing_email_cache[key] = True
+    return user
 
+
+def get_session(session_token):
+    """
+    Returns the SessionView of an unexpired session token, using the session
+    cache before falling back to the database
+    """
+    key = _digest(session_token.encode("utf8"))
+    with _session_cache_lock:
+        session = _session_cache.get(key)
+        if session is not None:
+            return session
+
+        load = _session_loads.get(key)
+        is_loader = load is None
+        if is_loader:
+            load = _session_loads[key] = concurrent.futures.Future()
+
+    # only one thread queries a given token; the others wait for its result,
+    # including a None result for an unknown or expired token
+    if not is_loader:
+        return load.result()
+
+    try:
+        # plain column fetch; no ORM instance is built for a session check
+        row = db.session.execute(
+            select(Users.id, Users.session_expiration)
+            .where(Users.session_token == session_token,
+                   Users.session_expiration > datetime.datetime.now())
+        ).first()
+        session = None if row is None else SessionView(*row)
+        if session is not None:
+            with _session_cache_lock:
+                _session_cache[key] = session
+    except BaseException as e:
+        load.set_exception(e)
+        raise
+    finally:
+        with _session_cache_lock:
+            del _session_loads[key]
+
+    load.set_result(session)
+    return session
+
+
+def cache_session(user):
+    """
+    Adds a user's current session token to the session cache
+
+    Returns the cached SessionView
+    """
+    session = SessionView(user.id, user.session_expiration)
+    key = _digest(user.session_token.encode("utf8"))
+    with _session_cache_lock:
+        _session_cache[key] = session
+    return session
+
+
+def verify_session(session_token):
+    """
+    Returns true if the session token belongs to a user and has not expired
+    """
+    return get_session(session_token) is not None
+
+
+def invalidate_session(session_token):
+    """
+    Removes a session token from the session cache, now and again once the
+    request's changes are committed
+    """
+    key = _digest(session_token.encode("utf8"))
+    with _session_cache_lock:
+        _session_cache.pop(key, None)
+    # evicted again once committed, see _evict_after_commit
+    db.session.info.setdefault("ended_sessions", []).append(key)
+    _clear_request_cache()
+
+
+@_request_cached
 def get_user_by_session_token(session_token):
     """
     Returns a user object from the database given a session token
+
+    Only the id and session columns are loaded up front; any other column is
+    loaded when it is first accessed
     """
-    return Users.query.filter(Users.session_token == session_token).first()
+    session = get_session(session_token)
+    if session is None:
+        return None
 
+    return db.session.get(
+        Users, session.user_id, options=[load_only(*_session_columns)])
 
+
+def get_users_by_session_tokens(session_tokens):
+    """
+    Returns a dict of session token to user object for the given session
+    tokens, fetched with a single query
+
+    Tokens that do not belong to a user or whose session has expired are
+    left out of the dict
+    """
+    if not session_tokens:
+        return {}
+
+    users = db.session.execute(
+        select(Users)
+        .where(Users.session_token.in_(session_tokens),
+               Users.session_expiration > datetime.datetime.now())
+        .options(load_only(*_session_columns))
+    ).scalars()
+    return {user.session_token: user for user in users}
+
+
+@_request_cached
 def get_user_by_update_token(update_token):
     """
     Returns a user object from the database given an update token
     """
-    return Users.query.filter(Users.update_token == update_token).first()
+    return db.session.execute(
+        select(Users).where(Users.update_token == update_token)
+    ).scalar_one_or_none()
 
 
 def verify_credentials(email, password):
     """
     Returns true if the credentials match, otherwise returns false
+
+    Successful logins are remembered briefly so repeated logins skip bcrypt
     """
+    key = _digest(email.encode("utf8") + b"\0" + password.encode("utf8"))
+    with _login_cache_lock:
+        login = _login_cache.get(key)
+
+    if login is not None:
+        user_id, password_digest = login
+        user = db.session.get(Users, user_id)
+        if (user is not None and user.email == email
+                and user.password_digest == password_digest):
+            cache_session(user)
+            return True, user
+
     optional_user = get_user_by_email(email)
 
     if optional_user is None:
         return False, None
 
-    return optional_user.verify_password(password), optional_user
+    if not optional_user.verify_password(password):
+        return False, optional_user
+
+    with _login_cache_lock:
+        _login_cache[key] = (optional_user.id, optional_user.password_digest)
+    cache_session(optional_user)
+    return True, optional_user
+
+
+def forget_logins(user_id):
+    """
+    Removes a user's remembered logins from the login cache
+    """
+    with _login_cache_lock:
+        keys = [key for key, (cached_id, _) in _login_cache.items()
+                if cached_id == user_id]
+        for key in keys:
+            _login_cache.pop(key, None)
 
 
 def create_user(name, netid, email, password):
@@ -46,15 +332,35 @@ def create_user(name, netid, email, password):
 
     Returns if creation was successful, and the User object
     """
+    # turn away taken emails with an indexed lookup before paying for bcrypt
     optional_user = get_user_by_email(email)
-
     if optional_user is not None:
         return False, optional_user
 
     user = Users(name=name, netid=netid, email=email, password=password)
 
+    # insert only if the email is still free; a concurrent signup with the
+    # same email may have claimed it since the lookup above
+    _clear_request_cache()
+    key = _digest(email.encode("utf8"))
+    with _missing_email_cache_lock:
+        _missing_email_cache.pop(key, None)
+    result = db.session.execute(
+        insert(Users)
+        .values({c.name: getattr(user, c.key)
+                 for c in Users.__table__.columns if not c.primary_key})
+        .on_conflict_do_nothing(index_elements=[Users.email]))
+
+    if result.rowcount == 0:
+        return False, get_user_by_email(email)
+
+    # attach the inserted row to the session without selecting it back
+    user.id = result.inserted_primary_key[0]
+    make_transient_to_detached(user)
     db.session.add(user)
-    db.session.commit()
+    cache_session(user)
+    # evicted again once committed, see _evict_after_commit
+    db.session.info.setdefault("created_emails", []).append(key)
 
     return True, user
 
@@ -69,6 +375,7 @@ def renew_session(update_token):
     if optional_user is None:
         return False, None
 
+    invalidate_session(optional_user.session_token)
     optional_user.renew_session()
-    db.session.commit()
+    cache_session(optional_user)
     return True, optional_user